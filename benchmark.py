@@ -0,0 +1,322 @@
+"""Benchmarks of the acquisition, logging, parsing and plotting hot paths.
+
+Runs headless (Agg backend) against the simulated control board, e.g.
+
+    python benchmark.py --output results.json
+    python benchmark.py --baseline results.json
+
+With --baseline the results are compared with an earlier run and the
+script exits with status 1 if any benchmark got slower than --threshold.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import struct
+import sys
+import tempfile
+import time
+
+import matplotlib
+
+matplotlib.use('Agg')
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+import GUI
+
+
+class BytesSerial:
+    """In-memory serial port replaying a byte string."""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    @property
+    def in_waiting(self):
+        return len(self.data) - self.pos
+
+    def read(self, size=1):
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += len(chunk)
+        return chunk
+
+    def readinto(self, buffer):
+        chunk = self.data[self.pos:self.pos + len(buffer)]
+        buffer[:len(chunk)] = chunk
+        self.pos += len(chunk)
+        return len(chunk)
+
+    def write(self, data):
+        return len(data)
+
+    def close(self):
+        pass
+
+
+def make_frame(cmd, payload):
+    msg = bytearray([0xfa, 0xaf, len(payload) + 5, cmd]) + payload
+    msg.append(sum(msg) % 256)
+    return bytes(msg)
+
+
+def make_rows(n, start=None):
+    """Returns n data rows sampled at 10 Hz, channels are slow random walks with noise."""
+    start = time.time() - n * 0.1 if start is None else start
+    random_state = np.random.RandomState(0)
+    rows = np.empty((n, len(GUI.DATA_COLUMNS)))
+    rows[:, 0] = start + np.arange(n) * 0.1
+    rows[:, 1:] = (np.cumsum(random_state.normal(0, 0.01, (n, len(GUI.DATA_COLUMNS) - 1)), axis=0) +
+                   random_state.normal(0, 0.002, (n, len(GUI.DATA_COLUMNS) - 1)))
+    return rows
+
+
+def timed(function, repeat):
+    """Returns the mean time of one call, s."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_protocol(results, repeat):
+    protocol = GUI.STMprotocol('SIM', simulator_options={'latency': 0, 'jitter': 0, 'seed': 0})
+    try:
+        results['protocol_send_command'] = (1 / timed(lambda: protocol.send_command(0x02, [5]), repeat),
+                                            'frames/s', True)
+        results['protocol_read_channels_pipelined'] = (1 / timed(protocol.read_channels, repeat), 'sets/s', True)
+        protocol.read_all = True
+        results['protocol_read_channels_read_all'] = (1 / timed(protocol.read_channels, repeat), 'sets/s', True)
+    finally:
+        protocol.close()
+
+    # Over a link with 2 ms latency each round trip costs at least 2 ms: the pipelined set should cost one
+    protocol = GUI.STMprotocol('SIM', simulator_options={'latency': 0.002, 'jitter': 0, 'seed': 0})
+    try:
+        results['protocol_read_channels_pipelined_2ms'] = (1 / timed(protocol.read_channels, repeat),
+                                                           'sets/s', True)
+        results['protocol_read_channels_serial_2ms'] = (
+            1 / timed(lambda: [protocol.send_command(cmd, args) for cmd, args in protocol.channel_requests],
+                      repeat), 'sets/s', True)
+    finally:
+        protocol.close()
+
+    # Decoding only, from memory
+    n_frames = repeat * 10
+    ser = BytesSerial(make_frame(0x02, struct.pack("=f", 25.0)) * n_frames)
+    decoder = GUI.FrameDecoder()
+    decoded = 0
+    start = time.perf_counter()
+    while decoded < n_frames:
+        frame = decoder.next_frame()
+        if frame is None:
+            decoder.feed(ser)
+        else:
+            struct.unpack("=f", frame[1])
+            decoded += 1
+    results['protocol_decode'] = (n_frames / (time.perf_counter() - start), 'frames/s', True)
+
+
+def bench_logging(results, directory, n_rows):
+    rows = make_rows(n_rows)
+    for name, file_name in (('csv', 'log.txt'), ('binary', 'log.bin')):
+        # AcquisitionSession.poll of a session that is not started: the simulated SMU stays paused and
+        # the samples are added to an acquisition thread that does not run
+        session = GUI.AcquisitionSession(smu_options={'resource': 'SIM'}, merge_options={'max_delay': 0},
+                                         metrics_interval=None)
+        session.res_1_value = 1.0
+        session.res_2_value = 2.0
+        session.data_file_name = os.path.join(directory, file_name)
+        session.acq_thread = GUI.AcquisitionThread('SIM', metrics=session.metrics)
+        session.start_file_writer()
+        ring = GUI.RingBuffer(n_rows)
+        start = time.perf_counter()
+        for i in range(0, n_rows, 10):
+            for row in rows[i:i + 10]:
+                session.acq_thread.add_sample(tuple(row[1:6]))
+            ring.extend(session.poll(flush=True))
+        session.file_writer.stop()
+        results['logging_get_data_' + name] = (n_rows / (time.perf_counter() - start), 'rows/s', True)
+        session.acq_thread.protocol.close()
+
+
+def bench_parsing(results, directory, sizes):
+    for n in sizes:
+        file_name = os.path.join(directory, 'data_{}.txt'.format(n))
+        with open(file_name, 'w') as file:
+            file.writelines(GUI.format_csv_row(row) for row in make_rows(n))
+
+        def tail_and_parse():
+            return GUI.CsvRecordReader(file_name).tail(n)
+
+        repeat = max(1, 20000 // n)
+        results['parse_tail_{}_lines'.format(n)] = (1000 * timed(tail_and_parse, repeat), 'ms/window', False)
+
+    # Time range query by seeking with the sparse index (built and cached on first use)
+    n = 20 * max(sizes)
+    file_name = os.path.join(directory, 'data_range.txt')
+    rows = make_rows(n)
+    with open(file_name, 'w') as file:
+        file.writelines(GUI.format_csv_row(row) for row in rows)
+    start = time.perf_counter()
+    GUI.CsvRecordReader(file_name).get_index()
+    results['parse_index_build'] = (n / (time.perf_counter() - start), 'lines/s', True)
+    middle = rows[n // 2][0]
+    results['parse_range_query'] = (1000 * timed(lambda: GUI.CsvRecordReader(file_name).rows_between(
+        middle, middle + 600), 20), 'ms/query', False)
+
+
+def bench_rendering(results, n_points, repeat):
+    data = make_rows(n_points).T.copy()
+    for mode in ('full', 'blit'):
+        figure = Figure(figsize=(16, 5), dpi=100)
+        canvas = FigureCanvasAgg(figure)
+        plots = GUI.TestbedPlots(figure)
+        if mode == 'blit':
+            plots.create_artists()
+            for artist in plots.artists:
+                artist.set_animated(True)
+        canvas.draw()
+
+        def frame():
+            # Move the window by one sample like a running acquisition
+            data[0] += 0.1
+            if GUI.draw_frame(plots, data, GUI.PARAMS_TEM, [0, 0], mode):
+                canvas.draw()
+            if mode == 'blit':
+                for artist in plots.artists:
+                    artist.axes.draw_artist(artist)
+                canvas.blit(figure.bbox)
+
+        frame()
+        results['render_frame_' + mode] = (1000 * timed(frame, repeat), 'ms/frame', False)
+
+
+def bench_model(results, n_loads, n_dtemps):
+    model = GUI.TegModel(**GUI.PARAMS_TEM)
+    loads = np.geomspace(0.1, 100, n_loads)
+    dtemps = np.linspace(1, 80, n_dtemps)
+    results['model_voltage_grid'] = (1000 * timed(lambda: model.voltages(
+        dtemps[:, None, None], loads[None, :, None], loads[None, None, :]), 5), 'ms/grid', False)
+
+    def max_power_point():
+        model.mpp_cache.clear()
+        model.max_power_point(dtemps)
+
+    results['model_max_power_point'] = (1000 * timed(max_power_point, 5), 'ms/search', False)
+
+
+def bench_storage(results, directory, n_days):
+    """Segmented store with a row per second for `n_days` (a soak test), written in hourly batches."""
+    store = os.path.join(directory, 'soak.seg')
+    rows = make_rows(n_days * 86400)
+    rows[:, 0] = time.time() - 86400 * n_days + np.arange(len(rows))
+    writer = GUI.SegmentedRecordWriter(store, {}, 1.0, 2.0, compress=True)
+    start = time.perf_counter()
+    for i in range(0, len(rows), 3600):
+        writer.write_rows(rows[i:i + 3600])
+    writer.close()
+    results['storage_write'] = (len(rows) / (time.perf_counter() - start), 'rows/s', True)
+
+    reader = GUI.SegmentedRecordReader(store)
+    stop_time = rows[-1, 0]
+    results['storage_window_24h_rollups'] = (1000 * timed(lambda: reader.plot_rows(
+        stop_time - 86400, stop_time, 1000), 20), 'ms/window', False)
+    results['storage_window_24h_raw'] = (1000 * timed(lambda: reader.rows_between(
+        stop_time - 86400, stop_time), 2), 'ms/window', False)
+
+
+def bench_rigs(results, directory, counts, duration, sample_rate=50):
+    """Headless runs of N simulated rigs (a process each): rows per second of
+    every rig and CPU time per row, which should not grow with N."""
+    for n in counts:
+        rigs = [('SIM', {'resource': 'SIM', 'nplc': 0.1})] * n
+        file_name = os.path.join(directory, 'rigs_{}.txt'.format(n))
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        # The rigs print their setup
+        with contextlib.redirect_stdout(io.StringIO()):
+            GUI.run_headless_rigs(rigs, file_name, duration=duration, sample_rate=sample_rate,
+                                  metrics_interval=None)
+        cpu = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = cpu.ru_utime + cpu.ru_stime - usage.ru_utime - usage.ru_stime
+        rows = []
+        for i in range(n):
+            with open(os.path.join(directory, 'rigs_{}_rig{}.txt'.format(n, i + 1)), 'rb') as file:
+                rows.append(sum(1 for _ in file))
+        results['rigs_{}_rows_per_rig'.format(n)] = (min(rows) / duration, 'rows/s', True)
+        results['rigs_{}_cpu_per_row'.format(n)] = (1e6 * cpu / sum(rows), 'us/row', False)
+
+
+def bench_metrics(results, n):
+    metrics = GUI.Metrics()
+    start = time.perf_counter()
+    for i in range(n):
+        metrics.record('board', 1e-6 * i)
+    results['metrics_record'] = (1e9 * (time.perf_counter() - start) / n, 'ns/record', False)
+    results['metrics_summary'] = (1000 * timed(metrics.summary, 50), 'ms/summary', False)
+
+
+def compare(results, baseline, threshold):
+    """Prints the results next to the baseline, returns the names of regressions."""
+    regressions = []
+    for name, result in results.items():
+        line = "{:40s} {:12.3f} {}".format(name, result['value'], result['unit'])
+        if name in baseline:
+            old = baseline[name]['value']
+            change = (result['value'] - old) / old if old else 0.0
+            # Positive change is always an improvement
+            if not result['higher_is_better']:
+                change = -change
+            line += "   baseline {:12.3f} ({:+.1f}%)".format(old, 100 * change)
+            if change < -threshold:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the testbed GUI hot paths.")
+    parser.add_argument('--output', default='benchmark_results.json', help="file to write the results to")
+    parser.add_argument('--baseline', help="results of an earlier run to compare with")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="relative slowdown reported as a regression (default 0.2)")
+    parser.add_argument('--quick', action='store_true', help="smaller workloads")
+    args = parser.parse_args()
+
+    repeat = 50 if args.quick else 500
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        bench_protocol(results, repeat)
+        bench_logging(results, directory, 10000 if args.quick else 100000)
+        bench_parsing(results, directory, (600, 10000) if args.quick else (600, 10000, 100000))
+        bench_rendering(results, 6000, 10 if args.quick else 50)
+        bench_model(results, 100 if args.quick else 300, 20 if args.quick else 100)
+        bench_storage(results, directory, 1 if args.quick else 7)
+        bench_metrics(results, 100000 if args.quick else 1000000)
+        bench_rigs(results, directory, (1, 4), 5 if args.quick else 20)
+
+    results = {name: {'value': value, 'unit': unit, 'higher_is_better': higher_is_better}
+               for name, (value, unit, higher_is_better) in results.items()}
+    with open(args.output, 'w') as file:
+        json.dump({'python': platform.python_version(), 'platform': platform.platform(),
+                   'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}, file, indent=2)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)['results']
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print("Regressions: " + ", ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,643 @@
+"""Tests of the testbed GUI against the simulated control board and SMU.
+
+    python -m pytest test_GUI.py
+"""
+import multiprocessing
+import os
+import resource
+import struct
+import threading
+import time
+import types
+
+import numpy as np
+import pytest
+import serial
+
+import GUI
+
+needs_pty = pytest.mark.skipif(GUI.pty is None, reason="the simulated board needs pseudo terminals")
+
+
+class BytesSerial:
+    """In-memory serial port returning at most `chunk` bytes per read."""
+
+    def __init__(self, data, chunk=7):
+        self.data = bytes(data)
+        self.pos = 0
+        self.chunk = chunk
+
+    @property
+    def in_waiting(self):
+        return min(len(self.data) - self.pos, self.chunk)
+
+    def readinto(self, buffer):
+        data = self.data[self.pos:self.pos + len(buffer)]
+        buffer[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+
+def frame(cmd, payload):
+    msg = bytearray([0xfa, 0xaf, len(payload) + 5, cmd]) + payload
+    msg.append(sum(msg) % 256)
+    return msg
+
+
+def decode_all(data):
+    decoder = GUI.FrameDecoder(size=64)
+    port = BytesSerial(data)
+    frames = []
+    while port.pos < len(port.data):
+        decoder.feed(port)
+        item = decoder.next_frame()
+        while item is not None:
+            frames.append((item[0], bytes(item[1])))
+            item = decoder.next_frame()
+    return decoder, frames
+
+
+@pytest.fixture
+def board():
+    simulator = GUI.SimulatedBoard(noise=0.0, seed=1)
+    simulator.start()
+    yield simulator
+    simulator.stop()
+
+
+def test_frame_decoder_splits_frames():
+    payloads = [struct.pack("=f", value) for value in range(20)]
+    decoder, frames = decode_all(b''.join(frame(0x02, payload) for payload in payloads))
+    assert frames == [(0x02, payload) for payload in payloads]
+    assert (decoder.frames_ok, decoder.crc_errors, decoder.resyncs) == (20, 0, 0)
+
+
+def test_frame_decoder_drops_corrupt_frames():
+    good = [frame(0x02, struct.pack("=f", 1.5)), frame(0x03, struct.pack("=f", 2.5)),
+            frame(0x06, struct.pack("=fffff", 1, 2, 3, 4, 5))]
+    bad_crc = frame(0x02, struct.pack("=f", 9.0))
+    bad_crc[-1] = (bad_crc[-1] + 1) % 256
+    data = b'\x00\x13\xfa' + good[0] + bad_crc + b'\xaf\xfa' + good[1] + frame(0x02, b'')[:3] + good[2]
+    decoder, frames = decode_all(data)
+    assert frames == [(msg[3], bytes(msg[4:-1])) for msg in good]
+    assert decoder.crc_errors >= 1
+    assert decoder.resyncs >= 2
+
+
+@needs_pty
+def test_protocol_reads_simulated_board(board):
+    protocol = GUI.STMprotocol(board.port)
+    try:
+        temp_1, temp_2, temp_3, volt_1, volt_2 = protocol.read_channels()
+        assert temp_1 == pytest.approx(25.0) and temp_3 == pytest.approx(25.0)
+        assert volt_1 == pytest.approx(0.0, abs=1e-6)
+        protocol.read_all = True
+        assert protocol.read_channels()[1] == pytest.approx(25.0)
+        assert protocol.decoder.crc_errors == 0
+    finally:
+        protocol.close()
+
+
+@needs_pty
+def test_protocol_survives_corrupt_replies():
+    protocol = GUI.STMprotocol('SIM', read_all=True, reply_timeout=0.05,
+                               simulator_options={'noise': 0.0, 'corrupt_rate': 0.3, 'seed': 2})
+    try:
+        values = []
+        for _ in range(50):
+            try:
+                values.append(protocol.read_channels())
+            except serial.SerialException:
+                pass
+        decoder = protocol.decoder
+        assert decoder.crc_errors + decoder.resyncs > 0
+        assert len(values) > 10
+        # Whatever got through is intact
+        assert all(value[0] == pytest.approx(25.0) for value in values)
+    finally:
+        protocol.close()
+
+
+@needs_pty
+def test_pipelined_requests_retry_missing_answers():
+    protocol = GUI.STMprotocol('SIM', simulator_options={'noise': 0.0, 'corrupt_rate': 0.1, 'tau': 1e-6,
+                                                         'seed': 3})
+    try:
+        protocol.send_command(0x04, [60.0])
+        expected = (25.0, 42.5, 60.0, 0.0036 * 35, 0.0033 * 35)
+        n_read = 0
+        for _ in range(100):
+            try:
+                values = protocol.read_channels()
+            except serial.SerialException:
+                continue
+            n_read += 1
+            # A corrupt answer never shifts the values of the other channels
+            assert values == pytest.approx(expected, rel=1e-5)
+        assert n_read > 90
+        assert protocol.decoder.crc_errors + protocol.decoder.resyncs > 0
+        assert protocol.batch_timeout() < 0.1
+    finally:
+        protocol.close()
+
+
+@needs_pty
+def test_read_all_retries_lost_answers():
+    # The default reply_timeout of 1 s would make each lost answer cost a second
+    protocol = GUI.STMprotocol('SIM', read_all=True, simulator_options={'noise': 0.0, 'corrupt_rate': 0.2,
+                                                                        'seed': 5})
+    try:
+        start = time.perf_counter()
+        n_read = 0
+        for _ in range(100):
+            try:
+                assert protocol.read_channels()[0] == pytest.approx(25.0)
+                n_read += 1
+            except serial.SerialException:
+                pass
+        assert n_read > 90
+        assert time.perf_counter() - start < 5.0
+    finally:
+        protocol.close()
+
+
+@needs_pty
+def test_pipelined_requests_share_the_link_latency():
+    protocol = GUI.STMprotocol('SIM', simulator_options={'latency': 0.005, 'jitter': 0.0, 'seed': 4})
+    try:
+        start = time.perf_counter()
+        for _ in range(5):
+            protocol.send_commands(protocol.channel_requests)
+        pipelined = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(5):
+            for cmd, args in protocol.channel_requests:
+                protocol.send_command(cmd, args)
+        one_by_one = time.perf_counter() - start
+        # 5 round trips against 25
+        assert pipelined < one_by_one / 2
+        assert pipelined >= 5 * 0.005
+    finally:
+        protocol.close()
+
+
+@needs_pty
+def test_stream_drops_stale_answers():
+    thread = GUI.AcquisitionThread('SIM', sample_rate=50, mode='stream')
+    thread.start()
+    try:
+        deadline = time.monotonic() + 2
+        while not thread.protocol.streaming and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # Answer to an earlier request that timed out
+        thread.protocol.replies.put((0x05, struct.pack("=BB", 0x05, 7)))
+        assert thread.protocol.send_command(0x05, [20.0]) == (0x05, 0)
+        assert thread.protocol.replies.empty()
+        time.sleep(0.1)
+        assert len(thread.get_samples()) > 0
+    finally:
+        thread.stop()
+
+
+def test_simulated_smu_measures_the_load():
+    smu = GUI.SimulatedSmu(load=1000.0, noise=0.0)
+    smu.write("VOLT 2.0, (@1)")
+    smu.write("SENS:VOLT:APER 0.001, (@1)")
+    assert smu.query("VOLT? (@1)").strip() == '2.0'
+    assert float(smu.query("MEAS:VOLT? (@1)")) == pytest.approx(2.0)
+    assert float(smu.query("MEAS:CURR? (@1)")) == pytest.approx(0.002)
+
+
+@pytest.mark.parametrize('mode', ['separate', 'single', 'buffered'])
+def test_smu_modes(mode):
+    session = GUI.AcquisitionSession(smu_options={'resource': 'SIM', 'mode': mode, 'aperture': 0.002,
+                                                  'buffer_depth': 4, 'simulator_options': {'noise': 0.0}},
+                                     metrics_interval=None)
+    task = session.smu_thread
+    assert task.smu.integration_time() == pytest.approx(0.002)
+    start = time.monotonic()
+    samples = task.smu_measure()
+    end = time.monotonic()
+    assert len(samples) == (4 if mode == 'buffered' else 1)
+    for volt, curr, host_time, smu_time in samples:
+        assert volt == pytest.approx(4.0)
+        assert curr == pytest.approx(4.0 / 40000.0)
+        assert start - 0.01 <= host_time <= end
+        assert np.isnan(smu_time) == (mode == 'separate')
+    assert [sample[2] for sample in samples] == sorted(sample[2] for sample in samples)
+
+
+def test_smu_task_stamps_pairs_and_survives_errors():
+    task = GUI.SmuThreadedTask(GUI.DropOldestQueue(), resource='SIM', aperture=0.02,
+                               simulator_options={'noise': 0.0})
+    task.daemon = True
+    start = time.monotonic()
+    sample = task.smu_measure()[0]
+    end = time.monotonic()
+    # Two 20 ms queries: the pair is stamped halfway, not after both
+    assert sample[2] == pytest.approx((start + end) / 2, abs=0.005)
+
+    query = task.smu.query
+    failures = [GUI.SMU_ERRORS[0]("timeout")]
+
+    def flaky_query(command):
+        if failures:
+            raise failures.pop()
+        return query(command)
+
+    task.smu.query = flaky_query
+    task.start()
+    task.resume_smu()
+    deadline = time.monotonic() + 2
+    while task.queue.qsize() < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    task.pause_smu()
+    assert task.errors_count == 1
+    assert task.queue.qsize() >= 2
+
+
+def smu_samples(smu, times):
+    samples = []
+    for t in times:
+        volt, curr = smu.measure()
+        samples.append([volt, curr, t, float('nan')])
+    return samples
+
+
+def test_sample_merger_nearest():
+    smu = GUI.SimulatedSmu(noise=0.0)
+    smu.write('VOLT 2')
+    now = time.monotonic()
+    merger = GUI.SampleMerger(tolerance=0.3)
+    merger.add_smu(smu_samples(smu, [now - 2.0, now - 1.0]))
+    merger.add_board([(now - 2.1, 'a'), (now - 1.5, 'b'), (now - 0.5, 'c')])
+    ready = merger.pop_ready()
+    # 'c' waits for a later SMU sample, 'b' is too far from both
+    assert [sample[1] for sample, _, _ in ready] == ['a', 'b']
+    assert ready[0][1:] == (pytest.approx(2.0), pytest.approx(2.0 / smu.load))
+    assert np.isnan(ready[1][1])
+    assert [sample[1] for sample, _, _ in merger.pop_ready(flush=True)] == ['c']
+
+
+def test_sample_merger_tolerance_and_flush():
+    smu = GUI.SimulatedSmu(noise=0.0)
+    smu.write('VOLT 1')
+    now = time.monotonic()
+    merger = GUI.SampleMerger(tolerance=0.3)
+    merger.add_smu(smu_samples(smu, [now - 2.0, now - 1.0]))
+    merger.add_board([(now - 1.5, 'far'), (now - 0.9, 'late')])
+    ready = merger.pop_ready(flush=True)
+    assert [sample[1] for sample, _, _ in ready] == ['far', 'late']
+    assert np.isnan(ready[0][1]) and np.isnan(ready[0][2])
+    assert ready[1][1] == pytest.approx(1.0)
+    assert len(merger.pending) == 0
+
+
+def test_sample_merger_interp():
+    smu = GUI.SimulatedSmu(noise=0.0)
+    now = time.monotonic()
+    merger = GUI.SampleMerger(tolerance=1.0, mode='interp')
+    smu.write('VOLT 1')
+    merger.add_smu(smu_samples(smu, [now - 2.0]))
+    smu.write('VOLT 3')
+    merger.add_smu(smu_samples(smu, [now - 1.0]))
+    merger.add_board([(now - 1.5, 'mid')])
+    (_, volt, curr), = merger.pop_ready()
+    assert volt == pytest.approx(2.0)
+    assert curr == pytest.approx(2.0 / smu.load)
+
+
+def test_minmax_decimate():
+    x = np.arange(1000.0)
+    ys = np.vstack((np.sin(x / 50), np.where(x == 500, np.nan, x)))
+    xs, ys_out = GUI.minmax_decimate(x, ys, 10)
+    assert ys_out.shape == (2, 20)
+    assert ys_out[0].max() == ys[0].max() and ys_out[0].min() == ys[0].min()
+    assert np.nanmax(ys_out[1]) == 999 and np.nanmin(ys_out[1]) == 0
+    np.testing.assert_array_equal(np.diff(xs, axis=1) >= 0, True)
+    # No buckets (an axis without width yet) still gives one
+    assert GUI.minmax_decimate(x, ys, 0)[1].shape == (2, 2)
+
+
+def test_shared_ring_wraps_and_counts_lost_rows():
+    ring = GUI.SharedSampleRing(capacity=8, n_columns=2)
+    try:
+        reader = GUI.SharedSampleRing(ring.name)
+        rows = np.column_stack([np.arange(30.0), -np.arange(30.0)])
+        ring.write(rows[:5])
+        np.testing.assert_array_equal(reader.read(), rows[:5])
+        # Wraps around the end of the ring
+        ring.write(rows[5:11])
+        np.testing.assert_array_equal(reader.read(), rows[5:11])
+        assert reader.lost == 0
+        # The reader falls behind by more than the capacity
+        ring.write(rows[11:20])
+        ring.write(rows[20:30])
+        np.testing.assert_array_equal(reader.read(), rows[22:30])
+        assert reader.lost == 11
+        assert len(reader.read()) == 0
+        # A new reader starts with the rows still in the ring
+        late = GUI.SharedSampleRing(ring.name)
+        np.testing.assert_array_equal(late.read(), rows[22:30])
+        ring.set_status({'running': 1, 'rows_written': 30})
+        assert reader.status()['rows_written'] == 30
+        late.close()
+        reader.close()
+    finally:
+        ring.close()
+
+
+@needs_pty
+def test_server_and_client(tmp_path):
+    session = GUI.AcquisitionSession(smu_options={'resource': 'SIM', 'nplc': 0.5}, merge_options={'max_delay': 0.5},
+                                     metrics_interval=None)
+    server = GUI.AcquisitionServer(session, GUI.SharedSampleRing(capacity=1000))
+    server.listen(('localhost', 0), b'secret')
+    address = server.listener.address
+    stop = threading.Event()
+    thread = threading.Thread(target=server.serve, kwargs={'until': stop.is_set})
+    data_file_name = str(tmp_path / 'data.txt')
+    try:
+        session.start('SIM', data_file_name, 1.0, 2.0)
+        thread.start()
+        with pytest.raises(multiprocessing.AuthenticationError):
+            GUI.AcquisitionClient.connect(address, b'wrong')
+        client = GUI.AcquisitionClient.connect(address, b'secret')
+        try:
+            assert (client.data_file_name, client.res_1_value, client.res_2_value) == (data_file_name, 1.0, 2.0)
+            client.set_resistances(3.0, 4.0)
+            time.sleep(1.5)
+            rows = client.poll()
+            assert len(rows) > 0
+            assert tuple(rows[-1, 6:8]) == (3.0, 4.0)
+            status = client.status()
+            assert status['running'] == 1 and status['samples'] > 0
+            assert client.health()['counters']['errors'] == 0
+            # A sweep to other loads waits until the operator confirms them
+            client.start_sweep([(25.0, 25.0, 5.0, 6.0)], None, {'settle_window': 1.0})
+            assert client.pending_load() == (5.0, 6.0)
+            client.confirm_load()
+            assert client.pending_load() is None
+            client.stop_sweep()
+            with pytest.raises(ValueError):
+                client.call('remove_everything')
+        finally:
+            client.close()
+    finally:
+        stop.set()
+        thread.join(5)
+        server.close()
+    # The server stops the session when it ends
+    assert not session.running
+    assert len(GUI.CsvRecordReader(data_file_name).tail(10)) > 0
+
+
+@needs_pty
+def test_headless_rigs_scale(tmp_path):
+    sample_rate = 20
+    cpu_per_row = {}
+    for n in (1, 3):
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        GUI.run_headless_rigs([('SIM', {'resource': 'SIM', 'nplc': 0.1})] * n, str(tmp_path / 'rigs_{}.txt'.format(n)),
+                              duration=2.0, sample_rate=sample_rate, metrics_interval=None)
+        cpu = resource.getrusage(resource.RUSAGE_CHILDREN)
+        rows = [len(GUI.CsvRecordReader(str(tmp_path / 'rigs_{}_rig{}.txt'.format(n, i + 1))).tail(1000))
+                for i in range(n)]
+        # Every rig keeps the sample rate
+        assert min(rows) >= 0.8 * 2.0 * sample_rate
+        cpu_per_row[n] = (cpu.ru_utime + cpu.ru_stime - usage.ru_utime - usage.ru_stime) / sum(rows)
+    # Rigs run in processes of their own: the cost of a row does not grow with their number
+    assert cpu_per_row[3] < 2 * cpu_per_row[1]
+
+
+def test_sweep_skips_points_the_board_does_not_take():
+    calls = []
+
+    def set_targets(t_hot, t_cold):
+        calls.append(t_hot)
+        # The second point always fails, the third once
+        if t_hot == 2 or (t_hot == 3 and calls.count(3) == 1):
+            raise serial.SerialTimeoutException("No answer from the control board")
+
+    session = types.SimpleNamespace(set_targets=set_targets, set_resistances=lambda res_1, res_2: None,
+                                    res_1_value=0.0, res_2_value=0.0)
+    sweep = GUI.SweepScheduler(session, [(1, 0, 0, 0), (2, 0, 0, 0), (3, 0, 0, 0)])
+    sweep.start()
+    assert (sweep.index, sweep.state) == (0, 'settling')
+    sweep.next_point()
+    assert (sweep.index, sweep.state) == (2, 'settling')
+    assert [result['result'] for result in sweep.results] == ['error']
+    assert calls == [1, 2, 2, 2, 3, 3]
+    sweep.next_point()
+    assert sweep.state == 'done'
+
+
+class SweepSession:
+    """Session of a sweep that logs the setpoints."""
+
+    def __init__(self):
+        self.res_1_value = 0.0
+        self.res_2_value = 0.0
+        self.calls = []
+
+    def set_resistances(self, res_1, res_2):
+        self.res_1_value = res_1
+        self.res_2_value = res_2
+        self.calls.append(('loads', res_1, res_2))
+
+    def set_targets(self, t_hot, t_cold):
+        self.calls.append(('targets', t_hot, t_cold))
+
+
+def test_sweep_waits_for_the_operator_to_change_loads():
+    session = SweepSession()
+    sweep = GUI.SweepScheduler(session, GUI.SweepScheduler.grid([50], [20], [0, 2], [0]))
+    sweep.start()
+    assert sweep.state == 'settling' and sweep.pending_load() is None
+    sweep.next_point()
+    # The targets are not touched before the loads are confirmed
+    assert sweep.state == 'waiting_load' and sweep.pending_load() == (2.0, 0.0)
+    assert session.calls == [('loads', 0.0, 0.0), ('targets', 50.0, 20.0)]
+    sweep.confirm_load()
+    assert sweep.state == 'settling'
+    assert session.calls[2:] == [('loads', 2.0, 0.0), ('targets', 50.0, 20.0)]
+    # No operator without a listener
+    with pytest.raises(ValueError):
+        GUI.run_headless('SIM', 'unused.txt', sweep=GUI.SweepScheduler.grid([50], [20], [0, 2], [0]))
+
+
+def test_sweep_sets_an_electronic_load():
+    session = SweepSession()
+    loads = []
+    sweep = GUI.SweepScheduler(session, [(50, 20, 1, 1), (50, 20, 2, 2)],
+                               set_load=lambda res_1, res_2: loads.append((res_1, res_2)))
+    sweep.start()
+    sweep.next_point()
+    assert sweep.state == 'settling'
+    assert loads == [(1.0, 1.0), (2.0, 2.0)]
+
+
+def data_rows(n, start=1.7e9, step=1.0, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.column_stack([start + step * np.arange(n), 25 + rng.standard_normal((n, len(GUI.DATA_COLUMNS) - 1))])
+
+
+def test_csv_reader_rows_between(tmp_path):
+    file_name = str(tmp_path / 'data.txt')
+    rows = data_rows(5000)
+    with open(file_name, 'w') as file:
+        file.writelines(GUI.format_csv_row(row) for row in rows)
+    reader = GUI.CsvRecordReader(file_name, chunk_size=4096, index_step=100)
+    for start, stop in [(1000, 1200), (0, 4999), (4990, 6000), (1234.5, 1234.5)]:
+        expected = rows[(rows[:, 0] >= rows[0, 0] + start) & (rows[:, 0] <= rows[0, 0] + stop)]
+        result = reader.rows_between(rows[0, 0] + start, rows[0, 0] + stop)
+        assert len(result) == len(expected)
+        np.testing.assert_array_equal(result[:, 0], expected[:, 0])
+        np.testing.assert_allclose(result[:, 1:], expected[:, 1:], atol=1e-6)
+    assert os.path.exists(file_name + '.idx.npz')
+    # The cached index is reused and extended when the file grows
+    with open(file_name, 'a') as file:
+        file.writelines(GUI.format_csv_row(row) for row in data_rows(10, start=rows[-1, 0] + 1))
+    reader = GUI.CsvRecordReader(file_name, chunk_size=4096, index_step=100)
+    assert len(reader.rows_between(rows[-1, 0] - 0.5, rows[-1, 0] + 100)) == 11
+
+
+def test_replay_of_an_empty_run(tmp_path):
+    csv_file_name = str(tmp_path / 'empty.txt')
+    open(csv_file_name, 'w').close()
+    bin_file_name = str(tmp_path / 'header_only.bin')
+    GUI.BinaryRecordWriter(bin_file_name, GUI.PARAMS_TEM, 1.0, 2.0).close()
+    for file_name in (csv_file_name, bin_file_name):
+        reader = GUI.open_data_file(file_name)
+        assert reader.time_range() is None
+        replay = GUI.RunReplay(reader, speed=10)
+        assert replay.empty
+        assert replay.poll().shape == (0, len(GUI.DATA_COLUMNS))
+
+
+def test_csv_fractional_seconds(tmp_path):
+    file_name = str(tmp_path / 'data.txt')
+    rows = data_rows(3000, step=0.1)
+    writer = GUI.CsvRecordWriter(file_name, fractional_seconds=True)
+    writer.write_rows(rows)
+    writer.close()
+    reader = GUI.CsvRecordReader(file_name, chunk_size=4096, index_step=100)
+    np.testing.assert_allclose(reader.tail(3000)[:, 0], rows[:, 0], atol=1e-3)
+    assert reader.time_range() == pytest.approx((rows[0, 0], rows[-1, 0]), abs=1e-3)
+    result = reader.rows_between(rows[1234, 0] - 0.05, rows[1300, 0] + 0.05)
+    np.testing.assert_allclose(result[:, 0], rows[1234:1301, 0], atol=1e-3)
+    # Rows appended to a file without the column keep its layout
+    old_file_name = str(tmp_path / 'old.txt')
+    with open(old_file_name, 'w') as file:
+        file.write(GUI.format_csv_row(rows[0]))
+    writer = GUI.CsvRecordWriter(old_file_name, fractional_seconds=True)
+    writer.write_rows(rows[1:10])
+    writer.close()
+    assert len(GUI.CsvRecordReader(old_file_name).tail(10)) == 10
+
+
+def test_session_file_writer_options(tmp_path):
+    session = GUI.AcquisitionSession(smu_options={'resource': 'SIM'}, metrics_interval=None,
+                                     writer_options={'flush_rows': 1, 'flush_interval_ms': None, 'fsync': True})
+    session.data_file_name = str(tmp_path / 'data.txt')
+    session.start_file_writer()
+    try:
+        writer = session.file_writer
+        assert (writer.flush_rows, writer.flush_interval_ms, writer.fsync) == (1, None, True)
+        writer.put_rows(data_rows(3))
+        deadline = time.monotonic() + 2
+        while writer.rows_pending > 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # On disk before the writer stops
+        with open(session.data_file_name) as file:
+            assert len(file.readlines()) == 3
+    finally:
+        session.file_writer.stop()
+
+
+def test_rollup_tier_matches_numpy(tmp_path):
+    file_name = str(tmp_path / 'rollup.bin')
+    rows = data_rows(1000, start=1.7e9 + 0.25, step=0.1)
+    rows[::7, 3] = np.nan
+    tier = GUI.RollupTier(file_name, 10)
+    for part in np.array_split(rows, 13):
+        tier.add_rows(part)
+    tier.close()
+    records = np.fromfile(file_name, dtype=GUI.ROLLUP_RECORD_DTYPE)
+    buckets = np.floor(rows[:, 0] / 10)
+    assert len(records) == len(np.unique(buckets))
+    for record, bucket in zip(records, np.unique(buckets)):
+        values = rows[buckets == bucket, 1:]
+        assert record['time'] == bucket * 10
+        assert record['count'] == len(values)
+        np.testing.assert_allclose(record['mean'], np.nanmean(values, axis=0), rtol=1e-6)
+        np.testing.assert_allclose(record['min'], np.nanmin(values, axis=0), rtol=1e-6)
+        np.testing.assert_allclose(record['max'], np.nanmax(values, axis=0), rtol=1e-6)
+
+
+def test_segmented_store(tmp_path):
+    directory = str(tmp_path / 'run.seg')
+    # Three whole hours ago up to now, the last rows in the hour in progress
+    now = time.time()
+    start = (now // 3600 - 3) * 3600
+    rows = np.concatenate((data_rows(3 * 3600, start=start), data_rows(3, start=now - 2)))
+    writer = GUI.SegmentedRecordWriter(directory, {}, 1, 2, segment_seconds=3600, compress=True)
+    for part in np.array_split(rows, 7):
+        writer.write_rows(part)
+    writer.close()
+
+    reader = GUI.SegmentedRecordReader(directory)
+    names = reader.segment_files()
+    # Rotated every hour, segments that are over are compressed
+    assert [reader.segment_start(name) for name in names] == [start + 3600 * i for i in range(4)]
+    assert all(name.endswith('.bin.gz') for name in names[:3]) and names[3].endswith('.bin')
+    assert reader.time_range() == pytest.approx((rows[0, 0], rows[-1, 0]))
+
+    # Across segments
+    np.testing.assert_allclose(reader.tail(5000), rows[-5000:], rtol=1e-6)
+    np.testing.assert_allclose(reader.rows_between(start + 3000, start + 4000), rows[3000:4001], rtol=1e-6)
+
+    # The coarsest tier with a bucket per point, raw rows if none is fine enough
+    stop = start + 3 * 3600 - 1
+    for n_points, width in ((100, 60), (1000, 1), (20000, None)):
+        plot_rows, end_time = reader.plot_rows(start, stop, n_points)
+        if width is None:
+            np.testing.assert_allclose(plot_rows, rows[:3 * 3600], rtol=1e-6)
+        else:
+            assert len(plot_rows) == 2 * 3 * 3600 // width
+            assert plot_rows[0, 0] == start + width / 4
+            assert end_time == start + 3 * 3600
+            np.testing.assert_allclose(plot_rows[1::2, 1].max(), rows[:3 * 3600, 1].max(), rtol=1e-6)
+
+
+def test_empty_segmented_store(tmp_path):
+    directory = str(tmp_path / 'run.seg')
+    GUI.SegmentedRecordWriter(directory, {}, 1, 2).close()
+    reader = GUI.open_data_file(directory)
+    assert reader.time_range() is None
+    assert GUI.RunReplay(reader).empty
+
+
+@needs_pty
+def test_rolling_stats_matches_numpy(board):
+    board.target_hot = 60.0
+    board.tau = 0.05
+    board.noise = 0.1
+    stats = GUI.RollingStats(window=0.5)
+    samples = []
+    start = time.monotonic()
+    while time.monotonic() - start < 1.5:
+        t = time.monotonic()
+        value = board.channel_values()[2]
+        samples.append((t, value))
+        stats.add(t, value)
+        stats.add(t, float('nan'))
+        time.sleep(0.005)
+    t, x = np.array(samples).T
+    inside = t >= t[-1] - 0.5
+    t, x = t[inside], x[inside]
+    assert stats.n == len(x)
+    assert stats.mean == pytest.approx(x.mean())
+    assert stats.std == pytest.approx(x.std(ddof=1))
+    assert (stats.min, stats.max) == (x.min(), x.max())
+    assert stats.slope == pytest.approx(np.polyfit(t - t[0], x, 1)[0])